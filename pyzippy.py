@@ -2,7 +2,9 @@ import python_minifier
 import re
 import urllib.parse
 import zlib
-import base64
+import binascii
+import functools
+import lzma
 
 r"""
 URL Allowed:
@@ -26,7 +28,7 @@ table = {
     "async": "P", "elif": "p", "if": "Q", "or": "q", "yield": "R",
 
     "!": "r", "@": "S", "#": "s", "%": "t", "^": "U", "&": "u", "*": "V", "(": "v", ")": "W", "[": "w",
-    "]": "X", "{": "x", "}": "Y", ";": "y", ":": "Z", "'": "z", "\"": "1", ",": "2", "/": "3", "`": "4",
+    "]": "X", "{": "x", "}": "Y", ";": "y", ":": "Z", "'": "z", "\"": "1", ",": "2", "/": "3",
     "\\": "6", "|": "7", "=": "8",
     "\n": "0",
     "\t": "T",
@@ -36,9 +38,11 @@ rev_table = {v: k for k, v in table.items()}
 
 """
 The first character indicates whether compression is used or not.
-If the original compressed string is over 1900 characters (by default), the string is compressed.
+If the original compressed string is over 1900 characters (by default), the string is compressed
+with whichever compressor yields the shortest result.
 0 -> Compression is not used
-1 -> Compression is Used
+1 -> Compressed with raw deflate
+2 -> Compressed with raw LZMA2
 
 Ident:
 Not everything can be compressed down into 1 symbol
@@ -47,65 +51,203 @@ So everything else that isnt in the table is labeled as `Ident`
 `Ident` has the following format:
 [1 char] 5 -> Identifier / Marker.  Never changes
 [1 char] Length -> how many chars `ident` takes up.  In base 62 with 0 = 1 char in length, Z = 62 char in length
-[var char] ident -> the actual name being contained 
+[var char] ident -> the actual name being contained
 
 There may be multiple `Ident` formats next to each other
+
+Since the same names repeat constantly in real code, the first 62 distinct `Ident`s
+are also remembered in order of appearance, and later occurrences are emitted as a
+back reference instead of the full name:
+[1 char] 4 -> Back reference / Marker.  Never changes
+[1 char] Index -> which remembered `Ident` to repeat, in base 62
 """
 
 base_62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-_kywds = re.compile("(" + "|".join(re.escape(x) for x in table.keys()) + ")")
+_base_62_index = {c: i for i, c in enumerate(base_62)}
+_char_table = {k: v for k, v in table.items() if len(k) == 1}
+_char_xlate = str.maketrans(_char_table)
+_kywds = re.compile(
+    r"\b(?:" + "|".join(sorted((x for x in table.keys() if len(x) > 1), key=len, reverse=True)) + r")\b")
+_ident_run = re.compile("([^" + re.escape("".join(_char_table)) + "]+)")
+# characters urllib.parse.quote never escapes; idents may carry anything else
+_url_safe = re.compile(r"[0-9A-Za-z_.~-]*\Z")
+_rev_single_xlate = str.maketrans({v: k for k, v in table.items() if len(k) == 1})
+_rev_multi = {v: k for k, v in table.items() if len(k) > 1}
+_multi_keys = re.compile("[" + re.escape("".join(_rev_multi)) + "]")
+# every symbol the encoder emits outside ident bodies is base-62
+_invalid_symbol = re.compile(r"[^0-9A-Za-z]")
+_marker = re.compile("[45]")
+
+_kywds_finditer = _kywds.finditer
+_ident_split = _ident_run.split
+_multi_sub = _multi_keys.sub
+_marker_search = _marker.search
+
+
+def _expand_keyword(m):
+    return _rev_multi[m.group()]
+
+
+_lzma_filters = [{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}]
+_b64_to_url = bytes.maketrans(b"+/", b"-_")
+_url_to_b64 = bytes.maketrans(b"-_", b"+/")
+
+
+def _b64encode(data: bytes) -> str:
+    return binascii.b2a_base64(data, newline=False).translate(_b64_to_url).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    data = text.encode("ascii").translate(_url_to_b64)
+    return binascii.a2b_base64(data + b"=" * (-len(data) % 4))
+
+
+def _deflate(data: bytes) -> bytes:
+    # raw deflate (no zlib header or adler32) -- we control both ends,
+    # so the 6 framing bytes are pure overhead before base64
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
 
+def _inflate(data: bytes) -> bytes:
+    return zlib.decompressobj(-15).decompress(data)
 
-def _form_ident(x: str):
-    segments = []
-    for s in range(0, len(x), 63):
-        segment = x[s * 63:(s + 1) * 63]
-        segments.append("5" + base_62[len(segment) - 1] + segment)
+
+def _form_segment(segment: str, seen: dict):
+    idx = seen.get(segment)
+    if idx is None:
+        seen[segment] = len(seen)
+    elif idx < 62:
+        return "4" + base_62[idx]
+    return "5" + base_62[len(segment) - 1] + segment
+
+
+def _form_ident(x: str, seen: dict):
+    length = len(x)
+    if length <= 62:
+        return _form_segment(x, seen)
+    segments = [None] * ((length + 61) // 62)
+    for i, s in enumerate(range(0, length, 62)):
+        segments[i] = _form_segment(x[s:s + 62], seen)
     return "".join(segments)
 
 
+def _form_plain(x: str, seen: dict):
+    # pieces alternates translatable single-char runs (even indices)
+    # with identifier runs captured by the split (odd indices)
+    pieces = _ident_split(x)
+    for i in range(0, len(pieces), 2):
+        pieces[i] = pieces[i].translate(_char_xlate)
+    for i in range(1, len(pieces), 2):
+        pieces[i] = _form_ident(pieces[i], seen)
+    return "".join(pieces)
+
+
+def _encode_core(txt: str):
+    seen = {}
+    parts = []
+    append = parts.append
+    last = 0
+    for m in _kywds_finditer(txt):
+        if m.start() > last:
+            append(_form_plain(txt[last:m.start()], seen))
+        append(table[m.group()])
+        last = m.end()
+    if last < len(txt):
+        append(_form_plain(txt[last:], seen))
+    return "".join(parts)
+
+
+def _compress_payload(payload_string: str):
+    data = payload_string.encode()
+    encoded = min(
+        "1" + _b64encode(_deflate(data)),
+        "2" + _b64encode(lzma.compress(data, format=lzma.FORMAT_RAW, filters=_lzma_filters)),
+        key=len)
+    # only return the compressed form... if it actually compressed it
+    return encoded if len(encoded) < len(payload_string) + 1 else "0" + payload_string
+
+
+@functools.lru_cache(maxsize=256)
 def _encode(txt: str, threshold_length: int = 1900):
-    payload_string = ""
-    for x in re.split(_kywds, txt):
-        if x == "":
-            continue
-        if x in table:
-            payload_string += table[x]
-            continue
-        payload_string += _form_ident(x)
-
+    # a source character never encodes to more than three symbols, so
+    # short inputs cannot reach the threshold and skip the check outright
+    if len(txt) * 3 <= threshold_length:
+        return "0" + _encode_core(txt)
+    payload_string = _encode_core(txt)
     if len(payload_string) > threshold_length:
-        encoded = "1" + base64.encodebytes(zlib.compress(payload_string.encode())).decode("ascii")
-        # only return the zlib compression... if it actually compressed it
-        return encoded if len(encoded) < len(payload_string) + 1 else "0" + payload_string
+        return _compress_payload(payload_string)
     return "0" + payload_string
 
 
+@functools.lru_cache(maxsize=512)
+def _minify(code: str, options: tuple) -> str:
+    options = list(options)
+    # python_minifier mutates the preserve lists, so hand it fresh copies
+    for i in (6, 8):
+        if options[i] is not None:
+            options[i] = list(options[i])
+    return python_minifier.minify(code, None, *options)
+
+
+def _quote(compressed: str, url_safe: bool) -> str:
+    if not url_safe or _url_safe.match(compressed):
+        return compressed
+    return urllib.parse.quote(compressed, safe="")
+
+
+def _expand_run(run: str):
+    # a run of single-symbol tokens between ident markers: one translate
+    # pass restores the 1:1 characters, one sub pass expands the keywords
+    bad = _invalid_symbol.search(run)
+    if bad:
+        raise ValueError(f"Invalid Symbol \"{bad.group()}\".  This symbol does not follow common procedure")
+    return _multi_sub(_expand_keyword, run.translate(_rev_single_xlate))
+
+
 def _decode(text: str):
     compression = text[0]
     text = text[1:]
     if compression == "1":
-        text = zlib.decompress(base64.decodebytes(text.encode("ascii"))).decode()
+        text = _inflate(_b64decode(text)).decode()
+    elif compression == "2":
+        text = lzma.decompress(_b64decode(text), format=lzma.FORMAT_RAW, filters=_lzma_filters).decode()
     pointer = 0
-    payload = ""
-    while pointer < len(text):
-        x = text[pointer]
-        pointer += 1
-        if x in rev_table:
-            payload += rev_table[x]
+    end = len(text)
+    payload = []
+    append = payload.append
+    search = _marker_search
+    defined = []
+    defined_set = set()
+    while pointer < end:
+        m = search(text, pointer)
+        if m is None:
+            append(_expand_run(text[pointer:]))
+            break
+        marker = m.start()
+        if marker > pointer:
+            append(_expand_run(text[pointer:marker]))
+        if marker + 1 >= end:
+            raise ValueError(f"Invalid Symbol \"{m.group()}\".  This symbol does not follow common procedure")
+        if m.group() == "4":
+            append(defined[_base_62_index[text[marker + 1]]])
+            pointer = marker + 2
             continue
-        elif x != "5":
-            raise ValueError(f"Invalid Symbol \"{x}\".  This symbol does not follow common procedure")
-        length = base_62.index(text[pointer]) + 1
-        pointer += 1
-        payload += text[pointer:pointer + length]
-        pointer += length
-    return payload
+        length = _base_62_index[text[marker + 1]] + 1
+        start = marker + 2
+        segment = text[start:start + length]
+        if segment not in defined_set:
+            defined_set.add(segment)
+            defined.append(segment)
+        append(segment)
+        pointer = start + length
+    return "".join(payload)
 
 
 def compress(code: str, *,
              url_safe: bool = True,
              threshold_length: int = 1900,
+             skip_minify_under: int = 0,
              remove_annotations: bool = True,
              remove_pass: bool = True,
              remove_literal_statements: bool = True,
@@ -134,8 +276,8 @@ def compress(code: str, *,
         '''
         compressed = compress(code)
         print(len(code), len(compressed), compressed)
-        # 148 94 0b952typE50g0k950Av53valsWZH952sumv53valsW050B850Avw50125022503XW051prE50tv50Avw50B25042505XWW
-        # compress reduced the length of the code by 54 characters
+        # 148 85 0b955typing0k950Av53valsWZH952sumv42W050B841vw50125022503XW054printv41vw4425042505XWW
+        # compress reduced the length of the code by 63 characters
 
     Parameters
     ----------
@@ -149,6 +291,11 @@ def compress(code: str, *,
         discarded and the previously compressed string is used. ``threshold_length`` is only used to prevent
         redundant work from being done.  If you want speedier compression with a potentially longer string, use
         a high value.  Default is ``1900`` characters in length.
+    skip_minify_under: :class:`int`
+        If ``code`` is at most this many characters, try encoding it as-is and skip
+        :func:`python_minifier.minify` entirely when the result is already short.  Parsing and
+        rewriting the AST dominates the cost of compressing small snippets, but the returned
+        code will not be minified.  ``0`` (always minify) by default.
     remove_annotations: :class:`bool`
         Used in the process for minifying code.  If ``code`` contains annotations that are necessary to the functionality
         at runtime, such as discord type annotations or dataclasses.dataclass annotations, disable this feature.
@@ -208,14 +355,22 @@ def compress(code: str, *,
     --------
     python_minifier : For more information on the minification process
     """
+    if len(code) <= skip_minify_under:
+        raw = _encode(code, threshold_length=threshold_length)
+        if len(raw) <= threshold_length // 4:
+            return _quote(raw, url_safe)
     remove_debug = not __debug__ if remove_debug is None else remove_debug
-    minify = python_minifier.minify(code, None, remove_annotations, remove_pass, remove_literal_statements,
-                                    combine_imports, hoist_literals, rename_locals, preserve_locals, rename_globals,
-                                    preserve_globals, remove_object_base, convert_posargs_to_args, preserve_shebang,
-                                    remove_asserts, remove_debug)
+    # every option must be hashable for the cache key
+    minify = _minify(code, (remove_annotations, remove_pass, remove_literal_statements,
+                            combine_imports, hoist_literals, rename_locals,
+                            tuple(preserve_locals) if preserve_locals is not None else None,
+                            rename_globals,
+                            tuple(preserve_globals) if preserve_globals is not None else None,
+                            remove_object_base, convert_posargs_to_args, preserve_shebang,
+                            remove_asserts, remove_debug))
 
     compressed = _encode(minify, threshold_length=threshold_length)
-    return urllib.parse.quote(compressed, safe="") if url_safe else compressed
+    return _quote(compressed, url_safe)
 
 
 def decompress(compressed_data: str) -> str:
@@ -237,5 +392,6 @@ def decompress(compressed_data: str) -> str:
     --------
     compress : for compression
     """
-    string = urllib.parse.unquote(compressed_data)
-    return _decode(string)
\ No newline at end of file
+    if "%" in compressed_data:
+        compressed_data = urllib.parse.unquote(compressed_data)
+    return _decode(compressed_data)
\ No newline at end of file